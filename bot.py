@@ -1,15 +1,26 @@
 import json
 import os
+import re
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from contextlib import contextmanager
 from dataclasses import dataclass, field
-from threading import Lock
-from typing import Mapping, Set
+from functools import lru_cache
+from queue import Empty, Queue
+from threading import Lock, Thread
+from typing import Iterable, Iterator, Protocol
 
 import click
+import requests
 from ape import Contract, accounts, chain
+from ape.exceptions import ProviderError
 from ape.types import LogFilter
+from requests.adapters import HTTPAdapter
 from silverback import SilverbackBot
-from web3 import Web3
+from urllib3.util import Retry
+from web3 import HTTPProvider, Web3
 
 bot = SilverbackBot()
 
@@ -47,12 +58,23 @@ def _load_reserves_from_env(prefix: str = "RESERVE_") -> dict[str, str]:
 
 POOL_ADDRESS = _require_checksum_addr(_required_env("POOL_ADDRESS"), "POOL_ADDRESS")
 POOL = Contract(POOL_ADDRESS)
+POOL_ADDR_LIST = [POOL.address]
+BORROW_ABI = POOL.Borrow.abi
+BORROW_TOPIC = Web3.to_hex(Web3.keccak(text=BORROW_ABI.selector))
 RESERVES = _load_reserves_from_env()
-ADDR_TO_SYMBOL = {addr: sym for sym, addr in RESERVES.items()}
 
 
-def addr(symbol: str) -> str | None:
-    return RESERVES.get(symbol)
+def _addr_bytes(a: str) -> bytes:
+    return bytes.fromhex(a[-40:])
+
+
+# Reserves keyed the same way as debtors and allowed_reserves: raw 20-byte addresses
+RESERVES_BYTES = {sym: _addr_bytes(a) for sym, a in RESERVES.items()}
+ADDR_BYTES_TO_SYMBOL = {a: sym for sym, a in RESERVES_BYTES.items()}
+
+
+def addr(symbol: str) -> bytes | None:
+    return RESERVES_BYTES.get(symbol)
 
 
 # Bot State
@@ -66,19 +88,29 @@ def _env_int(key: str, default: int) -> int:
         return default
 
 
-@dataclass
+@dataclass(slots=True)
 class BotState:
-    allowed_reserves: set[str] = field(default_factory=set)
+    allowed_reserves: frozenset[bytes] = frozenset()
     chunk_blocks: int = _env_int("CHUNK_BLOCKS", 100)
     scan_interval_blocks: int = _env_int("SCAN_INTERVAL_BLOCKS", 5)
     rpc_max_log_range: int = _env_int("RPC_MAX_LOG_RANGE", 10)
+    reserve_log_ranges: dict[bytes, int] = field(default_factory=dict)
     last_scan_block: int = 0
     next_end: int | None = None
-    seen_borrow_block: dict[str, int] = field(default_factory=dict)
-    backlog: set[str] = field(default_factory=set)
+    # 20-byte debtor -> last borrow height; stored as -(height + 1) while the debtor is in the
+    # backlog, which also holds them in FIFO order
+    borrowers: dict[bytes, int] = field(default_factory=dict)
+    backlog: deque[bytes] = field(default_factory=deque)
+    covered: list[tuple[int, int]] = field(default_factory=list)
     backfill_busy: bool = False
     lock: Lock = field(default_factory=Lock)
+    # Held for a whole scan (network I/O included) so each direction runs once at a time;
+    # lock itself is only taken to plan, enqueue and commit
+    forward_lock: Lock = field(default_factory=Lock)
+    backfill_lock: Lock = field(default_factory=Lock)
     last_backfill_head: int = 0
+    state_path: str | None = None
+    log_cache: "LogCache | None" = None
 
 
 def _cap_to_head(s: BotState, head: int) -> None:
@@ -88,40 +120,439 @@ def _cap_to_head(s: BotState, head: int) -> None:
         s.last_scan_block = min(s.last_scan_block, head)
 
 
-# Backfill
-def _iter_block_ranges(start_block: int, stop_block: int, step: int):
-    cur = start_block
-    while cur <= stop_block:
-        end = min(cur + step - 1, stop_block)
-        yield cur, end
-        cur = end + 1
+# Provider
+RPC_CONCURRENCY = max(1, _env_int("RPC_CONCURRENCY", 8))
+_RPC_ADAPTER = HTTPAdapter(
+    pool_connections=RPC_CONCURRENCY,
+    pool_maxsize=RPC_CONCURRENCY,
+    # 429s are left to ape's request_with_retry, which only backs off on an HTTPError
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=frozenset({"POST"}),
+    ),
+)
 
 
-def _iter_logs_range(addresses, events, start_block: int, stop_block: int, step: int):
-    if stop_block < start_block:
+def _pooled_session() -> requests.Session:
+    session = requests.Session()
+    session.mount("http://", _RPC_ADAPTER)
+    session.mount("https://", _RPC_ADAPTER)
+    return session
+
+
+def _bind_http_session() -> None:
+    p = accounts.provider.web3.provider
+    if not isinstance(p, HTTPProvider):
         return
-    for start, end in _iter_block_ranges(start_block, stop_block, step):
-        f = LogFilter(addresses=addresses, events=events, start_block=start, stop_block=end)
+    # web3 caches one requests.Session per thread; share a single connection pool across them
+    session = p._request_session_manager.cache_and_return_session(p.endpoint_uri)
+    if session.get_adapter(p.endpoint_uri) is not _RPC_ADAPTER:
+        session.mount("http://", _RPC_ADAPTER)
+        session.mount("https://", _RPC_ADAPTER)
+
+
+_bind_http_session()
+_RPC_POOL = ThreadPoolExecutor(max_workers=RPC_CONCURRENCY, initializer=_bind_http_session)
+
+
+# Backfill
+def _block_ranges(start_block: int, stop_block: int, step: int) -> list[tuple[int, int]]:
+    return [
+        (start, min(start + step - 1, stop_block))
+        for start in range(start_block, stop_block + 1, step)
+    ]
+
+
+RPC_STEP_MIN = max(1, _env_int("RPC_STEP_MIN", 1))
+RPC_STEP_MAX = max(RPC_STEP_MIN, _env_int("RPC_STEP_MAX", 2000))
+# Only block-range and response-size rejections; a throttled request is retried as is
+_RANGE_ERROR = re.compile(
+    r"block range|range (?:is )?too (?:large|wide|big)|limited to .*range|max(?:imum)? range"
+    r"|more than \d+ results|too many (?:results|logs)|response size"
+    r"|read timed out|query time(?:d )?out|timeout exceeded|execution timeout",
+    re.IGNORECASE,
+)
+_RATE_LIMIT = re.compile(
+    r"\b429\b|rate.?limit|too many requests|compute units|throughput|request rate|quota",
+    re.IGNORECASE,
+)
+RPC_RATE_LIMIT_RETRIES = max(0, _env_int("RPC_RATE_LIMIT_RETRIES", 5))
+# Providers that reject a range often say what would have worked
+_RANGE_HINT = re.compile(
+    r"block range of (\d+)|range (?:should work: )?\[(0x[0-9a-f]+), ?(0x[0-9a-f]+)\]", re.IGNORECASE
+)
+RPC_BATCH_SIZE = max(1, _env_int("RPC_BATCH_SIZE", 20))
+RPC_BLOOM_PRECHECK = _env_int("RPC_BLOOM_PRECHECK", 0) > 0
+RPC_SPLIT_RESERVES = _env_int("RPC_SPLIT_RESERVES", 0) > 0
+_BLOOM_BATCH = 50
+
+
+def _log_params(log_filter: LogFilter, start: int, end: int) -> dict:
+    f = log_filter.model_copy(update={"start_block": start, "stop_block": end})
+    return f.model_dump(mode="json")
+
+
+def _get_logs(log_filter: LogFilter, start: int, end: int) -> list[dict]:
+    # Same request as provider.get_contract_logs, minus its per-call head lookup, thread pool
+    # and ABI decoding; callers read the raw topics
+    return accounts.provider.make_request("eth_getLogs", [_log_params(log_filter, start, end)])
+
+
+def _get_logs_batch(log_filter: LogFilter, ranges: list[tuple[int, int]]) -> list:
+    calls = [("eth_getLogs", [_log_params(log_filter, start, end)]) for start, end in ranges]
+    responses = accounts.provider.web3.provider.make_batch_request(calls)
+    if not isinstance(responses, list):
+        raise ProviderError(str(responses.get("error", responses)))
+    # web3 sorts responses by request id, which follows call order; only trust a full set
+    if len(responses) != len(calls):
+        raise ProviderError(f"batch returned {len(responses)} of {len(calls)} responses")
+    return [ProviderError(str(r["error"])) if "error" in r else r["result"] for r in responses]
+
+
+def _try_get_logs(log_filter: LogFilter, start: int, end: int):
+    try:
+        return _get_logs(log_filter, start, end)
+    except Exception as ex:
+        return ex
+
+
+def _is_range_error(result: Exception) -> bool:
+    # A connect timeout is an outage, not a range the node took too long to serve
+    if isinstance(result, requests.ConnectionError):
+        return False
+    return _RANGE_ERROR.search(str(result)) is not None
+
+
+def _is_retryable(result) -> bool:
+    if not isinstance(result, Exception):
+        return False
+    return not _is_range_error(result) and not _RATE_LIMIT.search(str(result))
+
+
+def _range_hint(result: Exception) -> int | None:
+    m = _RANGE_HINT.search(str(result))
+    if m is None:
+        return None
+    if m.group(1):
+        return int(m.group(1))
+    return int(m.group(3), 16) - int(m.group(2), 16) + 1
+
+
+class ScanIncomplete(ProviderError):
+    def __init__(self, failed: list[tuple[int, int]], fetched: list[tuple[int, int]]):
+        self.failed = failed
+        self.fetched = fetched
+        super().__init__(f"{len(failed)} range(s) failed, first {failed[0][0]}-{failed[0][1]}")
+
+
+def _fetch_group(log_filter: LogFilter, group: list[tuple[int, int]]):
+    if len(group) > 1:
         try:
-            for log in accounts.provider.get_contract_logs(f):
-                yield log
+            results = _get_logs_batch(log_filter, group)
         except Exception as ex:
-            click.echo(f"[get_logs] {start}-{end} failed: {ex}")
+            click.echo(f"[get_logs] batch {group[0][0]}-{group[-1][1]} failed: {ex}")
+            if _RATE_LIMIT.search(str(ex)):
+                # Resending the batch as single requests would only add to the throttling
+                return [(r, ex) for r in group]
+        else:
+            # Range errors and throttling go back to the caller; anything else is retried alone
+            return [
+                (r, _try_get_logs(log_filter, *r) if _is_retryable(res) else res)
+                for r, res in zip(group, results)
+            ]
+    return [((start, end), _try_get_logs(log_filter, start, end)) for start, end in group]
+
+
+def _group_ranges(ranges: list[tuple[int, int]]) -> list[list[tuple[int, int]]]:
+    size = RPC_BATCH_SIZE if isinstance(accounts.provider.web3.provider, HTTPProvider) else 1
+    return [ranges[i : i + size] for i in range(0, len(ranges), size)]
+
+
+def _bloom_probe(item: bytes) -> tuple[tuple[int, int], ...]:
+    h = Web3.keccak(item)
+    bits = (((h[i] << 8) | h[i + 1]) & 2047 for i in (0, 2, 4))
+    return tuple((255 - b // 8, 1 << (b % 8)) for b in bits)
+
+
+def _bloom_probes(log_filter: LogFilter) -> list[list[tuple[tuple[int, int], ...]]]:
+    groups = [log_filter.addresses, *log_filter.topic_filter]
+    return [
+        [_bloom_probe(Web3.to_bytes(hexstr=v)) for v in (g if isinstance(g, list) else [g])]
+        for g in groups
+        if g
+    ]
+
+
+def _bloom_hits(bloom: bytes | None, probes) -> bool:
+    if bloom is None:
+        return True
+    return all(any(all(bloom[i] & m for i, m in p) for p in group) for group in probes)
+
+
+def _fetch_blooms(start_block: int, stop_block: int) -> dict[int, bytes]:
+    w3 = accounts.provider.web3
+    blooms: dict[int, bytes] = {}
+    for lo, hi in _block_ranges(start_block, stop_block, _BLOOM_BATCH):
+        with w3.batch_requests() as batch:
+            for n in range(lo, hi + 1):
+                batch.add(w3.eth.get_block(n))
+            for b in batch.execute():
+                blooms[b["number"]] = bytes(b["logsBloom"])
+    return blooms
+
+
+def _bloom_prune(
+    log_filter: LogFilter, ranges: list[tuple[int, int]], blooms: dict[int, bytes]
+) -> list[tuple[int, int]]:
+    probes = _bloom_probes(log_filter)
+    return [
+        (start, end)
+        for start, end in ranges
+        if any(_bloom_hits(blooms.get(n), probes) for n in range(start, end + 1))
+    ]
+
+
+def _try_fetch_blooms(start_block: int, stop_block: int) -> dict[int, bytes] | None:
+    try:
+        return _fetch_blooms(start_block, stop_block)
+    except Exception as ex:
+        click.echo(f"[bloom] precheck failed: {ex}")
+        return None
+
+
+def _reserve_lanes(log_filter: LogFilter) -> list[tuple[bytes | None, LogFilter]]:
+    topics = log_filter.topic_filter
+    reserves = topics[1] if len(topics) > 1 and isinstance(topics[1], list) else []
+    if not RPC_SPLIT_RESERVES or len(reserves) < 2:
+        return [(None, log_filter)]
+    return [
+        (
+            _addr_bytes(r),
+            log_filter.model_copy(update={"topic_filter": [topics[0], [r], *topics[2:]]}),
+        )
+        for r in reserves
+    ]
+
+
+def _lane_step(s: BotState, key: bytes | None) -> int:
+    step = s.rpc_max_log_range if key is None else s.reserve_log_ranges.get(key, 0)
+    return min(max(step or s.rpc_max_log_range, RPC_STEP_MIN), RPC_STEP_MAX)
+
+
+def _iter_logs_range(s: BotState, log_filter: LogFilter, start_block: int, stop_block: int):
+    if stop_block < start_block:
+        return
+    # With RPC_SPLIT_RESERVES each reserve is its own lane with its own adaptive step, so a busy
+    # reserve shrinks without dragging the quiet ones down; all lanes share one in-flight queue
+    lanes = _reserve_lanes(log_filter)
+    steps = [_lane_step(s, key) for key, _ in lanes]
+    blooms = _try_fetch_blooms(start_block, stop_block) if RPC_BLOOM_PRECHECK else None
+    queue: deque[tuple[int, list[tuple[int, int]]]] = deque()
+    for i, (_, f) in enumerate(lanes):
+        pending = _block_ranges(start_block, stop_block, steps[i])
+        if blooms is not None:
+            pending = _bloom_prune(f, pending, blooms)
+        queue.extend((i, group) for group in _group_ranges(pending))
+    if not queue:
+        return
+    shrunk = [False] * len(lanes)
+    fetched: list[list[tuple[int, int]]] = [[] for _ in lanes]
+    failed: list[tuple[int, int, int]] = []
+    throttled: dict[tuple[int, int, int], int] = {}
+    # (not before, lane, group) for throttled groups waiting out their backoff
+    deferred: list[tuple[float, int, list[tuple[int, int]]]] = []
+    inflight: dict = {}
+    while queue or inflight or deferred:
+        now = time.monotonic()
+        queue.extendleft((i, group) for due, i, group in deferred if due <= now)
+        deferred = [d for d in deferred if d[0] > now]
+        # Keep up to RPC_CONCURRENCY requests in flight; splits are queued as soon as they fail
+        while queue and len(inflight) < RPC_CONCURRENCY:
+            i, group = queue.popleft()
+            inflight[_RPC_POOL.submit(_fetch_group, lanes[i][1], group)] = i
+        wake = min(d[0] for d in deferred) - now if deferred else None
+        if not inflight:
+            time.sleep(wake)
             continue
+        done, _ = wait(inflight, timeout=wake, return_when=FIRST_COMPLETED)
+        backoff = 0.0
+        retry: dict[int, list[tuple[int, int]]] = {}
+        for fut in done:
+            i = inflight.pop(fut)
+            for (start, end), result in fut.result():
+                if not isinstance(result, Exception):
+                    yield from result
+                    fetched[i].append((start, end))
+                    continue
+                tries = throttled.get((i, start, end), 0)
+                if _RATE_LIMIT.search(str(result)) and tries < RPC_RATE_LIMIT_RETRIES:
+                    # Same range again after a pause; shrinking would only add requests
+                    throttled[(i, start, end)] = tries + 1
+                    backoff = max(backoff, min(30.0, 0.5 * 2**tries))
+                    retry.setdefault(i, []).append((start, end))
+                    continue
+                size = end - start + 1
+                if size > RPC_STEP_MIN and _is_range_error(result):
+                    hint = _range_hint(result) or size // 2
+                    steps[i] = max(RPC_STEP_MIN, min(steps[i], hint, size - 1))
+                    shrunk[i] = True
+                    split = _block_ranges(start, end, steps[i])
+                    queue.extend((i, group) for group in _group_ranges(split))
+                    continue
+                click.echo(f"[get_logs] {start}-{end} failed: {result}")
+                failed.append((i, start, end))
+        due = time.monotonic() + backoff
+        for i, ranges in retry.items():
+            deferred.extend((due, i, group) for group in _group_ranges(sorted(ranges)))
+    for i, (key, _) in enumerate(lanes):
+        if not failed and not shrunk[i] and stop_block - start_block + 1 >= steps[i]:
+            steps[i] = min(RPC_STEP_MAX, max(steps[i] + 1, int(steps[i] * 1.5)))
+        if key is None:
+            s.rpc_max_log_range = steps[i]
+        else:
+            s.reserve_log_ranges[key] = steps[i]
+    if failed:
+        # A block only counts as fetched once every lane has it
+        missing = [
+            gap
+            for i in {i for i, _, _ in failed}
+            for gap in _uncovered(_merge_all(fetched[i]), start_block, stop_block)
+        ]
+        raise ScanIncomplete(
+            sorted((start, end) for _, start, end in failed),
+            _uncovered(_merge_all(missing), start_block, stop_block),
+        )
+
+
+# Historical sources
+class HistoricalSource(Protocol):
+    def iter_logs(
+        self, s: BotState, log_filter: LogFilter, start_block: int, stop_block: int
+    ) -> Iterator: ...
+
+
+class JsonRpcSource:
+    def iter_logs(self, s: BotState, log_filter: LogFilter, start_block: int, stop_block: int):
+        return _iter_logs_range(s, log_filter, start_block, stop_block)
+
+
+# Only what _iter_borrowers_with_height reads; the data section is never fetched
+_HYPERSYNC_LOG_FIELDS = [
+    "block_number",
+    "topic0",
+    "topic1",
+    "topic2",
+    "topic3",
+]
+
+
+def _hypersync_topics(log_filter: LogFilter) -> list[list[str]]:
+    return [t if isinstance(t, list) else ([t] if t else []) for t in log_filter.topic_filter]
+
+
+def _hypersync_to_rpc_log(log: dict) -> dict:
+    topics = log.get("topics") or [log.get(f"topic{i}") for i in range(4)]
+    return {"topics": [t for t in topics if t], "blockNumber": hex(log["block_number"])}
+
 
+@dataclass(slots=True)
+class HyperSyncSource:
+    url: str
+    fallback: HistoricalSource
+    token: str | None = None
+    session: requests.Session = field(default_factory=_pooled_session)
+
+    def _query(self, log_filter: LogFilter, from_block: int, to_block: int) -> dict:
+        body = {
+            "from_block": from_block,
+            "to_block": to_block + 1,
+            "logs": [
+                {"address": list(log_filter.addresses), "topics": _hypersync_topics(log_filter)}
+            ],
+            "field_selection": {"log": _HYPERSYNC_LOG_FIELDS},
+        }
+        headers = {"Authorization": f"Bearer {self.token}"} if self.token else None
+        r = self.session.post(f"{self.url}/query", json=body, headers=headers, timeout=60)
+        r.raise_for_status()
+        return r.json()
+
+    def iter_logs(self, s: BotState, log_filter: LogFilter, start_block: int, stop_block: int):
+        cur = start_block
+        while cur <= stop_block:
+            try:
+                payload = self._query(log_filter, cur, stop_block)
+            except Exception as ex:
+                click.echo(f"[hypersync] {cur}-{stop_block} failed: {ex}")
+                break
+            data = payload.get("data") or []
+            for batch in data if isinstance(data, list) else [data]:
+                for log in batch.get("logs") or []:
+                    yield _hypersync_to_rpc_log(log)
+            nxt = int(payload.get("next_block", stop_block + 1))
+            if nxt <= cur:
+                break
+            cur = nxt
+        if cur > stop_block:
+            return
+        # A wide backfill window can leave far more than JSON-RPC should take in one go; cover
+        # the newest chunk_blocks and leave the rest uncommitted for a retry
+        lo = max(cur, stop_block - s.chunk_blocks + 1)
+        yield from self.fallback.iter_logs(s, log_filter, lo, stop_block)
+        if lo > cur:
+            fetched = [(start_block, cur - 1)] if cur > start_block else []
+            raise ScanIncomplete([(cur, lo - 1)], [*fetched, (lo, stop_block)])
+
+
+HYPERSYNC_URL = os.getenv("HYPERSYNC_URL", "").strip().rstrip("/")
+HYPERSYNC_TAIL_BLOCKS = max(0, _env_int("HYPERSYNC_TAIL_BLOCKS", 10_000))
+HYPERSYNC_CHUNK_BLOCKS = max(1, _env_int("HYPERSYNC_CHUNK_BLOCKS", 1_000_000))
+JSON_RPC_SOURCE = JsonRpcSource()
+HISTORICAL_SOURCE: HistoricalSource = (
+    HyperSyncSource(HYPERSYNC_URL, JSON_RPC_SOURCE, os.getenv("HYPERSYNC_API_TOKEN"))
+    if HYPERSYNC_URL
+    else JSON_RPC_SOURCE
+)
+
+
+def _iter_historical_logs(s: BotState, log_filter: LogFilter, start_block: int, stop_block: int):
+    # Bulk sources may lag the chain head; keep the recent tail on JSON-RPC
+    cut = min(stop_block, s.last_scan_block - HYPERSYNC_TAIL_BLOCKS)
+    if HISTORICAL_SOURCE is JSON_RPC_SOURCE or cut < start_block:
+        yield from JSON_RPC_SOURCE.iter_logs(s, log_filter, start_block, stop_block)
+        return
+    yield from HISTORICAL_SOURCE.iter_logs(s, log_filter, start_block, cut)
+    if cut < stop_block:
+        yield from JSON_RPC_SOURCE.iter_logs(s, log_filter, cut + 1, stop_block)
+
+
+@lru_cache(maxsize=1)
+def _borrow_log_filter(allowed: frozenset[bytes]) -> LogFilter:
+    # topics = [Borrow, [reserve, ...]]: the node drops other reserves before replying
+    return LogFilter.from_event(
+        BORROW_ABI,
+        search_topics={"reserve": [Web3.to_checksum_address(r) for r in sorted(allowed)]},
+        addresses=POOL_ADDR_LIST,
+    )
 
-def _iter_borrow_logs_range(start_block: int, stop_block: int, step: int):
-    return _iter_logs_range([POOL.address], [POOL.Borrow.abi], start_block, stop_block, step)
 
+def _iter_borrow_logs_range(s: BotState, start_block: int, stop_block: int):
+    f = _borrow_log_filter(s.allowed_reserves)
+    return _iter_historical_logs(s, f, start_block, stop_block)
 
-def _maybe_debtor(log, allowed: Set[str]) -> str | None:
-    return log.onBehalfOf if getattr(log, "reserve", None) in allowed else None
 
+def _maybe_debtor(log, allowed: frozenset[bytes]) -> bytes | None:
+    reserve = getattr(log, "reserve", None)
+    return _addr_bytes(log.onBehalfOf) if reserve and _addr_bytes(reserve) in allowed else None
 
-def _iter_borrowers_with_height(start_block: int, stop_block: int, step: int, allowed: set[str]):
-    for log in _iter_borrow_logs_range(start_block, stop_block, step):
-        if getattr(log, "reserve", None) in allowed:
-            yield (log.onBehalfOf, int(log.block_number))
+
+def _iter_borrowers_with_height(s: BotState, start_block: int, stop_block: int):
+    # Borrow(reserve indexed, user, onBehalfOf indexed, ...); the reserve is already filtered
+    # by the request topics. The debtor is the low 20 bytes of topic 2, decoded straight from hex
+    unhex = bytes.fromhex
+    for log in _iter_borrow_logs_range(s, start_block, stop_block):
+        yield unhex(log["topics"][2][-40:]), int(log["blockNumber"], 16)
 
 
 @contextmanager
@@ -134,16 +565,26 @@ def _try_lock(lock: Lock, timeout: float = 0.2):
             lock.release()
 
 
-def _enqueue_many_newer(addr_heights: Mapping[str, int], s: BotState) -> int:
+def _height(v: int) -> int:
+    return -v - 1 if v < 0 else v
+
+
+def _enqueue_many_newer(addr_heights: Iterable[tuple[bytes, int]], s: BotState) -> tuple[int, int]:
+    seen = 0
     added = 0
-    for a, h in addr_heights.items():
-        prev = s.seen_borrow_block.get(a)
-        if prev is None or h > prev:
-            s.seen_borrow_block[a] = h
-            if a not in s.backlog:
-                s.backlog.add(a)
-                added += 1
-    return added
+    borrowers = s.borrowers
+    get = borrowers.get
+    append = s.backlog.append
+    for a, h in addr_heights:
+        seen += 1
+        prev = get(a)
+        if prev is None or (prev >= 0 and h > prev):
+            borrowers[a] = -(h + 1)
+            append(a)
+            added += 1
+        elif prev < 0 and h > -prev - 1:
+            borrowers[a] = -(h + 1)
+    return seen, added
 
 
 FORWARD = "forward"
@@ -158,29 +599,89 @@ def _plan_window(s: BotState, head: int, mode: str) -> tuple[int, int] | None:
         stop = min(start + s.chunk_blocks - 1, head)
         return start, stop
     if mode == BACKFILL:
-        if s.next_end is None or s.next_end > head:
-            s.next_end = head
         stop = s.next_end
+        if stop is None or stop > head:
+            stop = s.next_end = head
         if stop < 1:
             return None
-        start = max(1, stop - s.chunk_blocks + 1)
+        size = s.chunk_blocks
+        if HISTORICAL_SOURCE is not JSON_RPC_SOURCE:
+            # Below the JSON-RPC tail a bulk source takes the whole range in one paged query
+            cut = s.last_scan_block - HYPERSYNC_TAIL_BLOCKS
+            size = HYPERSYNC_CHUNK_BLOCKS if stop <= cut else min(size, stop - cut)
+        start = max(1, stop - size + 1)
         if stop < start:
             return None
         return start, stop
     raise ValueError(f"unknown mode: {mode}")
 
 
-def _scan_window(s: BotState, start: int, stop: int) -> tuple[int, int]:
-    latest: dict[str, int] = {}
-    for a, h in _iter_borrowers_with_height(start, stop, s.rpc_max_log_range, s.allowed_reserves):
-        prev = latest.get(a)
-        if prev is None or h > prev:
-            latest[a] = h
-    added = _enqueue_many_newer(latest, s)
-    return len(latest), added
+def _merge_covered(covered: list[tuple[int, int]], start: int, stop: int) -> list[tuple[int, int]]:
+    out = []
+    for a, b in covered:
+        if b < start - 1 or a > stop + 1:
+            out.append((a, b))
+        else:
+            start, stop = min(a, start), max(b, stop)
+    out.append((start, stop))
+    out.sort()
+    return out
+
+
+def _merge_all(ranges: Iterable[tuple[int, int]]) -> list[tuple[int, int]]:
+    covered: list[tuple[int, int]] = []
+    for a, b in ranges:
+        covered = _merge_covered(covered, a, b)
+    return covered
+
+
+def _uncovered(covered: list[tuple[int, int]], start: int, stop: int) -> list[tuple[int, int]]:
+    gaps = []
+    cur = start
+    for a, b in covered:
+        if b < cur:
+            continue
+        if a > stop:
+            break
+        if a > cur:
+            gaps.append((cur, a - 1))
+        cur = b + 1
+    if cur <= stop:
+        gaps.append((cur, stop))
+    return gaps
+
+
+_ENQUEUE_BATCH = 1000
+
+
+def _enqueue_locked(s: BotState, pairs: list[tuple[bytes, int]]) -> tuple[int, int]:
+    with s.lock:
+        return _enqueue_many_newer(pairs, s)
+
+
+def _scan_window(
+    s: BotState, head: int, gaps: list[tuple[int, int]]
+) -> tuple[int, int, ScanIncomplete | None]:
+    # Pairs are enqueued in small batches as they arrive, so a wide window is never held in
+    # memory and s.lock is only taken briefly between fetches
+    logs = added = 0
+    error = None
+    batch: list[tuple[bytes, int]] = []
+    try:
+        for lo, hi in gaps:
+            for pair in _iter_cached_borrowers(s, head, lo, hi):
+                batch.append(pair)
+                if len(batch) >= _ENQUEUE_BATCH:
+                    n, a = _enqueue_locked(s, batch)
+                    logs, added, batch = logs + n, added + a, []
+    except ScanIncomplete as ex:
+        error = ex
+    n, a = _enqueue_locked(s, batch)
+    return logs + n, added + a, error
 
 
 def _commit_window(s: BotState, head: int, mode: str, start: int, stop: int) -> None:
+    s.covered = _merge_covered(s.covered, start, stop)
     if mode == FORWARD:
         s.last_scan_block = stop
         return
@@ -194,33 +695,48 @@ def _commit_window(s: BotState, head: int, mode: str, start: int, stop: int) ->
 def _sync_once(s: BotState, head: int, mode: str, max_windows: int = 1):
     if s is None:
         return {f"{mode}_skipped_no_state": 1}
-    if not s.lock.acquire(timeout=0.2):
+    scan_lock = s.forward_lock if mode == FORWARD else s.backfill_lock
+    if not scan_lock.acquire(timeout=0.2):
         return {f"{mode}_skipped_locked": 1}
     try:
         windows = 0
-        uniq_total = 0
+        logs_total = 0
         added_total = 0
         first_start = None
         last_stop = None
+        incomplete = 0
         while windows < max_windows:
-            plan = _plan_window(s, head, mode)
-            if plan is None:
+            with s.lock:
+                plan = _plan_window(s, head, mode)
+                if plan is None:
+                    break
+                start, stop = plan
+                gaps = _uncovered(s.covered, start, stop)
+
+            logs, added, error = _scan_window(s, head, gaps)
+
+            with s.lock:
+                if error is None:
+                    _commit_window(s, head, mode, start, stop)
+                else:
+                    # Cursors stay put so the window is retried; keep what did arrive so the
+                    # retry only asks for the holes
+                    for a, b in error.fetched:
+                        s.covered = _merge_covered(s.covered, a, b)
+            logs_total += logs
+            added_total += added
+            if error is not None:
+                click.echo(f"[{mode}] {start}-{stop} incomplete: {error}")
+                incomplete = 1
                 break
-            start, stop = plan
-
-            uniq, added = _scan_window(s, start, stop)
-            _commit_window(s, head, mode, start, stop)
 
             if first_start is None:
                 first_start = start
             last_stop = stop
-
             windows += 1
-            uniq_total += uniq
-            added_total += added
 
         if windows == 0:
-            return None
+            return {f"{mode}_incomplete": 1} if incomplete else None
 
         span = (last_stop - first_start + 1) if (first_start is not None) else 0
         return {
@@ -228,15 +744,16 @@ def _sync_once(s: BotState, head: int, mode: str, max_windows: int = 1):
             f"{mode}_first": first_start or 0,
             f"{mode}_last": last_stop or 0,
             f"{mode}_span": span,
-            f"{mode}_unique": uniq_total,
+            f"{mode}_logs": logs_total,
             f"{mode}_new": added_total,
+            f"{mode}_incomplete": incomplete,
             "backlog_size": len(s.backlog),
-            "seen_debtors_total": len(s.seen_borrow_block),
+            "seen_debtors_total": len(s.borrowers),
             "last_scan_block": s.last_scan_block,
             "next_end": s.next_end,
         }
     finally:
-        s.lock.release()
+        scan_lock.release()
 
 
 def _process_live_borrow(s: BotState, log):
@@ -247,15 +764,129 @@ def _process_live_borrow(s: BotState, log):
     with _try_lock(s.lock, 0.2) as got:
         if not got:
             return {"borrow_event_skipped_locked": 1}
-        added = _enqueue_many_newer({debtor: height}, s)
+        _, added = _enqueue_many_newer([(debtor, height)], s)
         return {
             "borrow_event": 1,
             "added_to_backlog": added,
             "backlog_size": len(s.backlog),
-            "seen_debtors_total": len(s.seen_borrow_block),
+            "seen_debtors_total": len(s.borrowers),
         }
 
 
+# Log cache
+LOG_CACHE_PATH = os.getenv("LOG_CACHE_PATH", "").strip()
+LOG_CACHE_CONFIRMATIONS = max(0, _env_int("LOG_CACHE_CONFIRMATIONS", 64))
+
+
+class LogCache:
+    # Borrows below the reorg depth never change; spans scanned once are served from disk
+    __slots__ = ("key", "db", "covered", "lock")
+
+    def __init__(self, path: str, key: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.key = key
+        # Forward and backfill scans share the connection from different threads
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS spans (key TEXT, start INTEGER, stop INTEGER);"
+            "CREATE TABLE IF NOT EXISTS borrows (key TEXT, block INTEGER, debtor BLOB);"
+            "CREATE INDEX IF NOT EXISTS borrows_key_block ON borrows (key, block);"
+        )
+        spans = self.db.execute("SELECT start, stop FROM spans WHERE key = ?", (key,))
+        self.covered = _merge_all(spans)
+
+    def read(self, start_block: int, stop_block: int) -> list[tuple[bytes, int]]:
+        with self.lock:
+            return self.db.execute(
+                "SELECT debtor, block FROM borrows WHERE key = ? AND block BETWEEN ? AND ?",
+                (self.key, start_block, stop_block),
+            ).fetchall()
+
+    def write(self, start_block: int, stop_block: int, pairs: list[tuple[bytes, int]]) -> None:
+        with self.lock:
+            covered = _merge_covered(self.covered, start_block, stop_block)
+            with self.db:
+                self.db.executemany(
+                    "INSERT INTO borrows VALUES (?, ?, ?)", [(self.key, h, a) for a, h in pairs]
+                )
+                self.db.execute("DELETE FROM spans WHERE key = ?", (self.key,))
+                self.db.executemany(
+                    "INSERT INTO spans VALUES (?, ?, ?)", [(self.key, a, b) for a, b in covered]
+                )
+            self.covered = covered
+
+
+def _log_cache_key(s: BotState) -> str:
+    reserves = ",".join(sorted(bytes(r).hex() for r in s.allowed_reserves))
+    return f"{POOL_ADDRESS}:{BORROW_TOPIC}:{reserves}"
+
+
+def _iter_cached_borrowers(s: BotState, head: int, start_block: int, stop_block: int):
+    cache = s.log_cache
+    if cache is None:
+        yield from _iter_borrowers_with_height(s, start_block, stop_block)
+        return
+    yield from cache.read(start_block, stop_block)
+    final = head - LOG_CACHE_CONFIRMATIONS
+    for lo, hi in _uncovered(cache.covered, start_block, stop_block):
+        if lo > final:
+            yield from _iter_borrowers_with_height(s, lo, hi)
+            continue
+        cut = min(hi, final)
+        # Pass pairs on as they arrive; a ScanIncomplete skips the write, not the pairs
+        pairs = []
+        for pair in _iter_borrowers_with_height(s, lo, cut):
+            pairs.append(pair)
+            yield pair
+        cache.write(lo, cut, pairs)
+        if cut < hi:
+            yield from _iter_borrowers_with_height(s, cut + 1, hi)
+
+
+# Background backfill
+BACKFILL_WINDOWS = max(1, _env_int("BACKFILL_WINDOWS", 1))
+# Heads handed over by handle_blocks; None stops the worker
+_backfill_heads: Queue[int | None] = Queue()
+
+
+def _latest_backfill_head(head: int | None) -> int | None:
+    # Only the newest head matters; older ones would plan the same window
+    while head is not None:
+        try:
+            head = _backfill_heads.get_nowait()
+        except Empty:
+            break
+    return head
+
+
+def _backfill_worker(s: BotState) -> None:
+    while True:
+        head = _latest_backfill_head(_backfill_heads.get())
+        if head is None:
+            return
+        if head - s.last_backfill_head < s.scan_interval_blocks:
+            continue
+        s.backfill_busy = True
+        try:
+            stats = _sync_once(s, head, BACKFILL, max_windows=BACKFILL_WINDOWS)
+        except Exception as ex:
+            stats = None
+            click.echo(f"[backfill] {head} failed: {ex}")
+        finally:
+            s.backfill_busy = False
+        if stats:
+            click.echo(f"[backfill] {stats}")
+
+
+def _start_backfill_worker(s: BotState) -> None:
+    Thread(target=_backfill_worker, args=(s,), name="backfill", daemon=True).start()
+
+
+def _stop_backfill_worker() -> None:
+    _backfill_heads.put(None)
+
+
 # Persistence
 def _session_dir(bot_name: str | None = None) -> str:
     name = os.getenv("BOT_NAME", bot_name or "bot")
@@ -278,8 +909,11 @@ def _state_to_jsonable(s: BotState) -> dict:
     return {
         "next_end": s.next_end,
         "last_scan_block": s.last_scan_block,
-        "seen_borrow_block": s.seen_borrow_block,
-        "backlog": sorted(s.backlog),
+        "seen_borrow_block": {
+            Web3.to_checksum_address(a): _height(v) for a, v in s.borrowers.items()
+        },
+        "backlog": [Web3.to_checksum_address(a) for a in s.backlog],
+        "covered": s.covered,
     }
 
 
@@ -288,18 +922,31 @@ def _state_from_jsonable(d: dict) -> BotState:
     if "next_end" in d:
         s.next_end = d["next_end"]
     s.last_scan_block = int(d.get("last_scan_block", s.last_scan_block))
-    s.seen_borrow_block = {k: int(v) for k, v in d.get("seen_borrow_block", {}).items()}
-    s.backlog = set(d.get("backlog", []))
+    s.covered = [(int(a), int(b)) for a, b in d.get("covered", [])]
+    s.borrowers = {_addr_bytes(k): int(v) for k, v in d.get("seen_borrow_block", {}).items()}
+    for a in map(_addr_bytes, d.get("backlog", [])):
+        v = s.borrowers.get(a, 0)
+        if v >= 0:
+            s.borrowers[a] = -(v + 1)
+            s.backlog.append(a)
     return s
 
 
 def _atomic_write_json(path: str, obj: dict) -> None:
-    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    d = os.path.dirname(os.path.abspath(path))
+    os.makedirs(d, exist_ok=True)
     tmp = f"{path}.tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(obj, f, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    data = json.dumps(obj, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    with open(tmp, "wb") as f:
+        f.write(data.encode("utf-8"))
         f.flush()
+        os.fsync(f.fileno())
     os.replace(tmp, path)
+    dfd = os.open(d, os.O_RDONLY)
+    try:
+        os.fsync(dfd)
+    finally:
+        os.close(dfd)
 
 
 def _restore_state(path: str | None = None) -> tuple[BotState | None, str]:
@@ -316,7 +963,7 @@ def _restore_state(path: str | None = None) -> tuple[BotState | None, str]:
 
 
 def _save_state(s: BotState, path: str | None = None) -> str:
-    p = path or _resolve_state_path()
+    p = path or s.state_path or _resolve_state_path()
     try:
         _atomic_write_json(p, _state_to_jsonable(s))
     except Exception as e:
@@ -331,7 +978,10 @@ def init_state(startup_state):
     restored = s is not None
     if s is None:
         s = BotState()
-    s.allowed_reserves = set(RESERVES.values())
+    s.state_path = path
+    s.allowed_reserves = frozenset(RESERVES_BYTES.values())
+    if LOG_CACHE_PATH:
+        s.log_cache = LogCache(LOG_CACHE_PATH, _log_cache_key(s))
     head = chain.blocks.head.number
     if s.next_end is None:
         last = (
@@ -344,6 +994,9 @@ def init_state(startup_state):
         s.last_scan_block = head
     _cap_to_head(s, head)
     bot.state.data = s
+    _start_backfill_worker(s)
+    if not getattr(chain.provider, "ws_uri", None):
+        click.echo("[provider] no websocket URI configured; blocks and Borrow logs will be polled")
     click.echo(
         f"[state] {'restored' if restored else 'fresh'} init; path={path}, next_end={s.next_end}"
     )
@@ -353,13 +1006,17 @@ def init_state(startup_state):
 def handle_blocks(b):
     s = bot.state.data
     head = b.number
+    backfill_due = head - s.last_backfill_head >= s.scan_interval_blocks
     if head > s.last_scan_block:
         stats = _sync_once(s, head, FORWARD, max_windows=4)
         if stats and stats.get("forward_windows", 0) > 0 and s.last_scan_block < head:
             return {"catchup_in_progress": 1, **stats}
-    if head - s.last_backfill_head < s.scan_interval_blocks:
+    if not backfill_due:
         return
-    return _sync_once(s, head, BACKFILL, max_windows=1)
+    if s.backfill_busy:
+        return {"backfill_busy": 1}
+    _backfill_heads.put(head)
+    return {"backfill_signaled": 1}
 
 
 @bot.on_(POOL.Borrow, filter_args={"reserve": list(RESERVES.values())})
@@ -370,10 +1027,12 @@ def on_borrow(log):
 @bot.on_shutdown()
 def handle_on_shutdown():
     s = bot.state.data
-    path = _save_state(s)
+    _stop_backfill_worker()
+    with s.lock:
+        path = _save_state(s)
     click.echo(f"[state] snapshot saved to: {path}")
     return {
         "backlog_size": len(s.backlog),
-        "seen_debtors_total": len(s.seen_borrow_block),
+        "seen_debtors_total": len(s.borrowers),
         "state_saved": True,
     }